@@ -1,18 +1,22 @@
 import argparse
 from collections import defaultdict
-import glob
+import functools
+import io
+import math
+import multiprocessing
 import os
+import queue
+import struct
+import threading
 
 import cv2
 from geometry_msgs.msg import TransformStamped
 import numpy as np
 import rospy
-from sensor_msgs.msg import Image, PointField, CameraInfo
+from sensor_msgs.msg import CompressedImage, Image, PointCloud2, PointField, CameraInfo
 from nav_msgs.msg import Odometry
-import sensor_msgs.point_cloud2 as point_cloud2
 from std_msgs.msg import Header
 import tensorflow
-import tf
 from tf2_msgs.msg import TFMessage
 import tqdm
 from transforms3d.axangles import axangle2mat
@@ -40,64 +44,144 @@ SELECTED_LIDAR_SENSOR = {
 # https://github.com/waymo-research/waymo-open-dataset/issues/93
 NORMALIZE_INTENSITY = True
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+# Camera images in the waymo open dataset are jpeg compressed
+# if set True, they are written as is to /camera/<name>/image/compressed,
+# otherwise they are decoded and written to /camera/<name>/image
+COMPRESS_IMAGES = True
+
+# /tf_static is written once per tfrecord from the first frame
+# if set True, it is recomputed for every frame and checked to be unchanged
+VERIFY_STATIC_TF = False
+
+# Layout of the points written to /lidar/<name>/pointcloud, shared by all messages
+POINT_FIELDS = [
+    PointField("x", 0, PointField.FLOAT32, 1),
+    PointField("y", 4, PointField.FLOAT32, 1),
+    PointField("z", 8, PointField.FLOAT32, 1),
+    PointField("intensity", 12, PointField.FLOAT32, 1),
+]
+
+# Rotation from the waymo camera frame (x forward, y left, z up)
+# to the ROS optical frame (z forward, x right, y down)
+CAMERA_TO_IMAGE = np.array(
+    [[ 0,  0,  1,  0],
+     [-1,  0,  0,  0],
+     [ 0, -1,  0,  0],
+     [ 0,  0,  0,  1]], dtype=np.float64)
+
+# Rectification matrix of the cameras, images are not rectified
+CAMERA_R = np.eye(3).ravel().tolist()
+
+# lidar extraction runs on CPU unless CUDA_VISIBLE_DEVICES is set explicitly
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
 
 
 class Waymo2Bag(object):
     def __init__(self, load_dir, save_dir,
-            tracking_max_distance=-1):
-        # turn on eager execution for older tensorflow versions
-        if int(tensorflow.__version__.split(".")[0]) < 2:
-            tensorflow.enable_eager_execution()
+            tracking_max_distance=-1, num_workers=1):
+        init_tensorflow()
 
         self.load_dir = load_dir
         self.save_dir = save_dir
         self.tracking_max_distance = tracking_max_distance
-        self.tfrecord_pathnames = sorted(glob.glob(f"{self.load_dir}/*.tfrecord"))
+        self.num_workers = num_workers
+        # hidden files are skipped like glob does, e.g. macOS "._*.tfrecord" metadata files
+        self.tfrecord_pathnames = sorted(
+            entry.path for entry in os.scandir(self.load_dir)
+            if entry.is_file() and entry.name.endswith(".tfrecord")
+            and not entry.name.startswith(".")
+        )
 
         self.static_tf_message = None
+        self.camera_infos = None
+        self.front_image_idx = None
+        self.lidar_calibrations = dict()
 
     def __len__(self):
         return len(self.tfrecord_pathnames)
 
     def convert(self):
         print("start converting ...")
-        for i in range(len(self)):
-            self.convert_tfrecord2bag(i)
-            self.static_tf_message = None
+        num_workers = min(self.num_workers, len(self))
+        if num_workers > 1:
+            # every tfrecord is converted to its own bag, so files are converted in parallel.
+            # workers are spawned because tensorflow does not support fork,
+            # and share the cores instead of each sizing its thread pools to all of them
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(
+                num_workers, initializer=init_tensorflow, initargs=(num_threads,)
+            ) as pool:
+                # progress bars of the workers would overwrite each other,
+                # so progress is shown over files instead
+                convert_tfrecord2bag = functools.partial(
+                    self.convert_tfrecord2bag, show_progress=False
+                )
+                try:
+                    for _ in tqdm.tqdm(
+                        pool.imap_unordered(convert_tfrecord2bag, range(len(self))),
+                        total=len(self),
+                    ):
+                        pass
+                except Exception:
+                    # leaving the pool terminates the workers before they close their bags,
+                    # so let them convert the remaining files first. On KeyboardInterrupt
+                    # the workers are terminated and their unfinished bags have no index
+                    pool.close()
+                    pool.join()
+                    raise
+        else:
+            for i in range(len(self)):
+                self.convert_tfrecord2bag(i)
         print("finished ...")
 
-    def convert_tfrecord2bag(self, file_idx):
+    def convert_tfrecord2bag(self, file_idx, show_progress=True):
+        # a worker converts several files, so reset the state cached for the previous one
+        self.static_tf_message = None
+        self.camera_infos = None
+        self.lidar_calibrations = dict()
+
         pathname = self.tfrecord_pathnames[file_idx]
+        # stream records instead of loading the whole file, so reading the next frames
+        # overlaps with converting the current one
         dataset = tensorflow.data.TFRecordDataset(pathname, compression_type="")
-        dataset = list(dataset)
+        dataset = dataset.prefetch(tensorflow.data.experimental.AUTOTUNE)
+        # a streamed dataset has no length, so records are counted for the progress bar
+        num_frames = count_tfrecord_records(pathname) if show_progress else None
 
         filename = os.path.basename(pathname).split(".")[0]
         bag = rosbag.Bag(
             f"{self.save_dir}/" + str(filename) + ".bag", "w", compression=rosbag.Compression.NONE
         )
+        bag_writer = AsyncBagWriter(bag)
         tracking = list()
         object_ids = dict()
         print("filename: %s" % str(filename))
 
         try:
-            for frame_idx, data in enumerate(tqdm.tqdm(dataset)):
-                frame = dataset_pb2.Frame()
-                frame.ParseFromString(bytearray(data.numpy()))
+            frame = dataset_pb2.Frame()
+            for frame_idx, data in enumerate(
+                tqdm.tqdm(dataset, total=num_frames, disable=not show_progress)
+            ):
+                # numpy() of a string tensor is already bytes, ParseFromString clears the frame
+                frame.ParseFromString(data.numpy())
 
                 timestamp = rospy.Time.from_sec(frame.timestamp_micros * 1e-6)
-                # self.write_tf(bag, frame, timestamp)
-                self.write_odom(bag, frame, timestamp)
-                self.write_tf_static(bag, frame, timestamp)
-                self.write_point_cloud(bag, frame, timestamp)
-                self.write_image(bag, frame, timestamp)
-                self.write_camera_info(bag, frame, timestamp)
+                # self.write_tf(bag_writer, frame, timestamp)
+                self.write_odom(bag_writer, frame, timestamp)
+                self.write_tf_static(bag_writer, frame, timestamp)
+                self.write_point_cloud(bag_writer, frame, timestamp)
+                self.write_image(bag_writer, frame, timestamp)
+                self.write_camera_info(bag_writer, frame, timestamp)
                 self.write_tracking(tracking, frame, frame_idx, object_ids)
         finally:
-            print(bag)
-            bag.close()
-            with open(f"{self.save_dir}/" + str(filename) + ".txt", 'w') as f:
-                f.writelines(tracking)
+            try:
+                bag_writer.close()
+            finally:
+                print(bag)
+                bag.close()
+                with open(f"{self.save_dir}/" + str(filename) + ".txt", 'w') as f:
+                    f.writelines(tracking)
 
     def write_tracking(self, tracking, frame, frame_idx, object_ids):
         vehicle_pose = np.array(frame.pose.transform).reshape(4, 4)
@@ -165,6 +249,9 @@ class Waymo2Bag(object):
         bag.write("/odom", odom_msg, t=timestamp)
 
     def write_tf_static(self, bag, frame, timestamp):
+        if self.static_tf_message is not None and not VERIFY_STATIC_TF:
+            return
+
         tf_message = TFMessage()
         for camera_calibration in frame.context.camera_calibrations:
             frame_name = \
@@ -174,12 +261,7 @@ class Waymo2Bag(object):
 
             vehicle_to_camera = \
                 np.array(camera_calibration.extrinsic.transform).reshape(4, 4)
-            camera_to_image = np.array(
-                [[ 0,  0,  1,  0],
-                 [-1,  0,  0,  0],
-                 [ 0, -1,  0,  0],
-                 [ 0,  0,  0,  1]])
-            tf_matrix = np.matmul(vehicle_to_camera, camera_to_image)
+            tf_matrix = np.matmul(vehicle_to_camera, CAMERA_TO_IMAGE)
             tf_msg = to_transform(
                 from_frame_id="base_link",
                 to_frame_id=frame_name,
@@ -226,29 +308,69 @@ class Waymo2Bag(object):
             frame (waymo_open_dataset.dataset_pb2.Frame): frame info
             timestamp (rospy.rostime.Time): timestamp of a frame
         """
-        for image in frame.images:
-            frame_name = dataset_pb2.CameraName.Name.Name(image.name).lower()
-            if frame_name != 'front':
-                continue
+        # cameras are stored in the same order in every frame, so the index is looked up once
+        self.front_image_idx = find_camera(
+            frame.images, dataset_pb2.CameraName.FRONT, hint=self.front_image_idx
+        )
+        if self.front_image_idx is None:
+            return
+        image = frame.images[self.front_image_idx]
+        frame_name = 'front'
 
-            img_bgr = cv2.imdecode(np.frombuffer(image.image, np.uint8), cv2.IMREAD_COLOR)
-            img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+        if COMPRESS_IMAGES:
+            image_msg = CompressedImage()
+            image_msg.header = Header(frame_id=frame_name, stamp=timestamp)
+            image_msg.format = "jpeg"
+            image_msg.data = image.image
+
+            bag.write(
+                "/camera/{}/image/compressed".format(frame_name), image_msg, t=timestamp
+            )
+            return
 
-            # image_msg = CompressedImage()
-            # image_msg.header = Header(frame_id=frame_name, stamp=timestamp)
-            # image_msg.format = "jpeg"
-            # image_msg.data = np.array(cv2.imencode('.jpg', img_rgb)[1]).tostring()
+        img_rgb = cv2.imdecode(np.frombuffer(image.image, np.uint8), cv2.IMREAD_COLOR)
+        # swap channels in place to avoid allocating another image
+        cv2.cvtColor(img_rgb, cv2.COLOR_BGR2RGB, dst=img_rgb)
 
-            image_msg = Image()
-            image_msg.header = Header(frame_id=frame_name, stamp=timestamp)
-            image_msg.height = img_rgb.shape[0]
-            image_msg.width = img_rgb.shape[1]
-            image_msg.encoding = "rgb8"
-            image_msg.data = img_rgb.tostring()
+        image_msg = Image()
+        image_msg.header = Header(frame_id=frame_name, stamp=timestamp)
+        image_msg.height = img_rgb.shape[0]
+        image_msg.width = img_rgb.shape[1]
+        image_msg.encoding = "rgb8"
+        image_msg.data = img_rgb.tobytes()
 
-            bag.write("/camera/{}/image".format(frame_name), image_msg, t=timestamp)
+        bag.write("/camera/{}/image".format(frame_name), image_msg, t=timestamp)
 
     def write_camera_info(self, bag, frame, timestamp):
+        if self.camera_infos is None:
+            self.camera_infos = dict()
+            for frame_name, cam_info in self.get_camera_infos(frame).items():
+                serialized_cam_info = serialize_message(cam_info)
+                # only the header stamp changes between frames. Check once that patching it
+                # in the serialized bytes gives the same bytes as serializing the message
+                cam_info.header.stamp = timestamp
+                assert set_serialized_header_stamp(serialized_cam_info, timestamp) == \
+                    serialize_message(cam_info)
+                self.camera_infos[frame_name] = serialized_cam_info
+
+        for frame_name, serialized_cam_info in self.camera_infos.items():
+            data = set_serialized_header_stamp(serialized_cam_info, timestamp)
+
+            bag.write(
+                "/camera/{}/camera_info".format(frame_name),
+                (CameraInfo._type, data, CameraInfo._md5sum, CameraInfo),
+                t=timestamp,
+                raw=True,
+            )
+
+    def get_camera_infos(self, frame):
+        """Build camera info messages, calibration does not change within a tfrecord
+        Args:
+            frame (waymo_open_dataset.dataset_pb2.Frame): frame info
+        Returns:
+            dict: {frame_name: sensor_msgs.msg.CameraInfo} without header stamps
+        """
+        camera_infos = dict()
         for camera_calibration in frame.context.camera_calibrations:
             frame_name = \
                 dataset_pb2.CameraName.Name.Name(camera_calibration.name).lower()
@@ -257,24 +379,21 @@ class Waymo2Bag(object):
 
             cam_info = CameraInfo()
             cam_info.header.frame_id = frame_name
-            cam_info.header.stamp = timestamp
             cam_info.width = camera_calibration.width
             cam_info.height = camera_calibration.height
             cam_info.distortion_model = "plumb_bob"
             cam_info.D.extend(camera_calibration.intrinsic[4:])
-            K = np.eye(3)
-            K[0][0] = camera_calibration.intrinsic[0]
-            K[1][1] = camera_calibration.intrinsic[1]
-            K[0][2] = camera_calibration.intrinsic[2]
-            K[1][2] = camera_calibration.intrinsic[3]
-            cam_info.K = K.ravel().tolist()
-            R = np.eye(3)
-            cam_info.R = R.ravel().tolist()
-            P = np.zeros((3, 4))
-            P[0:3, 0:3] = K
-            cam_info.P = P.ravel().tolist()
-
-            bag.write("/camera/{}/camera_info".format(frame_name), cam_info, t=timestamp)
+            fx, fy, cx, cy = camera_calibration.intrinsic[0:4]
+            cam_info.K = [fx, 0., cx,
+                          0., fy, cy,
+                          0., 0., 1.]
+            cam_info.R = CAMERA_R
+            cam_info.P = [fx, 0., cx, 0.,
+                          0., fy, cy, 0.,
+                          0., 0., 1., 0.]
+
+            camera_infos[frame_name] = cam_info
+        return camera_infos
 
     def write_point_cloud(self, bag, frame, timestamp):
         """parse and save the lidar data in psd format
@@ -290,22 +409,25 @@ class Waymo2Bag(object):
             _,
             range_image_top_pose,
         ) = frame_utils.parse_range_image_and_camera_projection(frame)
-        ret_dict = convert_range_image_to_point_cloud(
+        ret_dict = self.convert_range_image_to_point_cloud(
             frame, range_images, camera_projections, range_image_top_pose, ri_indexes=(0, 1)
         )
 
         def write_points_to_bag(points, lidar_name):
             # pointcloud is already transformed to base_link
 
-            fields = [
-                PointField("x", 0, PointField.FLOAT32, 1),
-                PointField("y", 4, PointField.FLOAT32, 1),
-                PointField("z", 8, PointField.FLOAT32, 1),
-                PointField("intensity", 12, PointField.FLOAT32, 1),
-            ]
-            pcl_msg = point_cloud2.create_cloud(
-                Header(frame_id="base_link", stamp=timestamp), fields, points
-            )
+            # pack the float32 points directly instead of struct-packing them one by one
+            points = np.ascontiguousarray(points, dtype=np.float32)
+            pcl_msg = PointCloud2()
+            pcl_msg.header = Header(frame_id="base_link", stamp=timestamp)
+            pcl_msg.height = 1
+            pcl_msg.width = points.shape[0]
+            pcl_msg.fields = POINT_FIELDS
+            pcl_msg.is_bigendian = False
+            pcl_msg.point_step = points.itemsize * points.shape[1]
+            pcl_msg.row_step = pcl_msg.point_step * pcl_msg.width
+            pcl_msg.is_dense = True
+            pcl_msg.data = points.tobytes()
 
             bag.write("/lidar/{}/pointcloud".format(lidar_name), pcl_msg, t=pcl_msg.header.stamp)
 
@@ -322,21 +444,249 @@ class Waymo2Bag(object):
                 axis=0,
             )
 
+            # concatenate x, y, z and intensity into a single float32 array
+            xyzi = np.empty((points.shape[0], 4), dtype=np.float32)
+            xyzi[:, 0:3] = points
             if NORMALIZE_INTENSITY:
-                intensity = np.tanh(intensity)
-
-            # concatenate x, y, z and intensity
-            points = np.column_stack((points, intensity))
+                np.tanh(intensity, out=xyzi[:, 3])
+            else:
+                xyzi[:, 3] = intensity
+            points = xyzi
             concat_points.append(points)
 
             write_points_to_bag(points, lidar_name)
 
         # write_points_to_bag(np.concatenate(concat_points, axis=0), "concatenated")
 
+    def convert_range_image_to_point_cloud(
+        self, frame, range_images, camera_projections, range_image_top_pose, ri_indexes=(0, 1)
+    ):
+        """Convert range images to point cloud. modified from
+        https://github.com/waymo-research/waymo-open-dataset/blob/master/waymo_open_dataset/utils/range_image_utils.py#L612
+
+        Args:
+          frame: open dataset frame
+           range_images: A dict of {laser_name, [range_image_first_return,
+             range_image_second_return]}.
+           camera_projections: A dict of {laser_name,
+             [camera_projection_from_first_return,
+             camera_projection_from_second_return]}.
+          range_image_top_pose: range image pixel pose for top lidar.
+          ri_indexes: 0 for the first return, 1 for the second return.
+        Returns:
+          points: {[N, 3]} list of 3d lidar points of length 5 (number of lidars).
+          cp_points: {[N, 6]} list of camera projections of length 5
+            (number of lidars).
+        """
+        tf = tensorflow
+        calibrations = sorted(frame.context.laser_calibrations, key=lambda c: c.name)
+        ret_dict = defaultdict(list)
+
+        frame_pose = tf.convert_to_tensor(
+            value=np.reshape(np.array(frame.pose.transform), [4, 4])
+        )
+        # [H, W, 6]
+        range_image_top_pose_tensor = tf.reshape(
+            tf.convert_to_tensor(value=range_image_top_pose.data), range_image_top_pose.shape.dims
+        )
+        # [H, W, 3, 3]
+        range_image_top_pose_tensor_rotation = transform_utils.get_rotation_matrix(
+            range_image_top_pose_tensor[..., 0],
+            range_image_top_pose_tensor[..., 1],
+            range_image_top_pose_tensor[..., 2],
+        )
+        range_image_top_pose_tensor_translation = range_image_top_pose_tensor[..., 3:]
+        range_image_top_pose_tensor = transform_utils.get_transform(
+            range_image_top_pose_tensor_rotation, range_image_top_pose_tensor_translation
+        )
+
+        for c in calibrations:
+            beam_inclinations, extrinsic = self.get_lidar_calibration(
+                c, range_images[c.name][ri_indexes[0]]
+            )
+
+            # [B, H, W, C], all returns of the lidar are extracted in a single batch
+            range_image_tensor = tf.stack(
+                [
+                    tf.reshape(
+                        tf.convert_to_tensor(value=range_images[c.name][ri_index].data),
+                        range_images[c.name][ri_index].shape.dims,
+                    )
+                    for ri_index in ri_indexes
+                ]
+            )
+            pixel_pose_local = None
+            frame_pose_local = None
+            if c.name == dataset_pb2.LaserName.TOP:
+                pixel_pose_local = range_image_top_pose_tensor
+                pixel_pose_local = tf.expand_dims(pixel_pose_local, axis=0)
+                frame_pose_local = tf.expand_dims(frame_pose, axis=0)
+            points_tensor, intensity_tensor, num_points = extract_point_cloud(
+                range_image_tensor,
+                extrinsic,
+                beam_inclinations,
+                pixel_pose=pixel_pose_local,
+                frame_pose=frame_pose_local,
+            )
+
+            # points of the batch are ordered by return, split them back
+            sections = np.cumsum(num_points.numpy())[:-1]
+            points = np.split(points_tensor.numpy(), sections)
+            intensity = np.split(intensity_tensor.numpy(), sections)
+            for i, ri_index in enumerate(ri_indexes):
+                ret_dict["points_{}_{}".format(c.name, ri_index)].append(points[i])
+                ret_dict["intensity_{}_{}".format(c.name, ri_index)].append(intensity[i])
+
+        return ret_dict
+
+    def get_lidar_calibration(self, calibration, range_image):
+        """Get beam inclinations and extrinsic of a lidar, cached for the current tfrecord
+        Args:
+            calibration (waymo_open_dataset.dataset_pb2.LaserCalibration): lidar calibration
+            range_image (waymo_open_dataset.dataset_pb2.MatrixFloat): range image of the lidar
+        Returns:
+            beam_inclinations: [1, H] tensor of beam inclinations.
+            extrinsic: [1, 4, 4] tensor of the lidar extrinsic.
+        """
+        tf = tensorflow
+        if calibration.name in self.lidar_calibrations:
+            return self.lidar_calibrations[calibration.name]
+
+        if len(calibration.beam_inclinations) == 0:
+            beam_inclinations = range_image_utils.compute_inclination(
+                tf.constant([calibration.beam_inclination_min, calibration.beam_inclination_max]),
+                height=range_image.shape.dims[0],
+            )
+        else:
+            beam_inclinations = tf.constant(calibration.beam_inclinations)
+
+        beam_inclinations = tf.reverse(beam_inclinations, axis=[-1])
+        extrinsic = np.reshape(np.array(calibration.extrinsic.transform), [4, 4])
+
+        self.lidar_calibrations[calibration.name] = (
+            tf.expand_dims(beam_inclinations, axis=0),
+            tf.expand_dims(tf.convert_to_tensor(value=extrinsic), axis=0),
+        )
+        return self.lidar_calibrations[calibration.name]
+
+
+def init_tensorflow(num_threads=None):
+    """
+    Args:
+        num_threads (int): size of the tensorflow thread pools, all cores if None
+    """
+    if num_threads is not None:
+        tensorflow.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tensorflow.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+    # turn on eager execution for older tensorflow versions
+    if int(tensorflow.__version__.split(".")[0]) < 2:
+        tensorflow.enable_eager_execution()
+
+
+class AsyncBagWriter(object):
+    """Write messages to a bag from a background thread, so that serialization
+    and disk I/O overlap with converting the next frame.
+    Messages must not be modified after they are passed to write().
+    """
+
+    def __init__(self, bag, maxsize=8):
+        """
+        Args:
+            bag (rosbag.Bag): bag to write
+            maxsize (int): max number of queued messages, write() blocks when the queue is full
+        """
+        self.bag = bag
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def write(self, topic, msg, t=None, raw=False):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((topic, msg, t, raw))
+
+    def close(self):
+        """Wait until all queued messages are written. The bag itself is not closed."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining the queue so that write() never blocks forever
+                continue
+            topic, msg, t, raw = item
+            try:
+                self.bag.write(topic, msg, t=t, raw=raw)
+            except Exception as e:
+                self.error = e
+
+
+def serialize_message(msg):
+    buff = io.BytesIO()
+    msg.serialize(buff)
+    return buff.getvalue()
+
+
+def set_serialized_header_stamp(serialized_msg, stamp):
+    """Replace the header stamp of a serialized message
+    Args:
+        serialized_msg (bytes): message that starts with a std_msgs/Header
+        stamp (rospy.rostime.Time): new stamp
+    Returns:
+        bytes: serialized message with the new stamp
+    """
+    # the stamp is serialized right after the uint32 header seq.
+    # rosbag requires bytes for raw messages, bytearray is rejected
+    return serialized_msg[:4] + struct.pack("<2I", stamp.secs, stamp.nsecs) + serialized_msg[12:]
+
+
+def find_camera(items, camera_name, hint=None):
+    """Find the image or calibration of a camera
+    Args:
+        items: frame.images or frame.context.camera_calibrations
+        camera_name (int): waymo_open_dataset.dataset_pb2.CameraName value
+        hint (int): index to check first
+    Returns:
+        int: index of the camera in items, None if not found
+    """
+    if hint is not None and hint < len(items) and items[hint].name == camera_name:
+        return hint
+    for i, item in enumerate(items):
+        if item.name == camera_name:
+            return i
+    return None
+
+
+def quaternion_from_matrix(mat):
+    """Quaternion (x, y, z, w) of the rotation part of a 4x4 rigid transform (Shepperd's method)"""
+    m00, m01, m02 = mat[0][0], mat[0][1], mat[0][2]
+    m10, m11, m12 = mat[1][0], mat[1][1], mat[1][2]
+    m20, m21, m22 = mat[2][0], mat[2][1], mat[2][2]
+    trace = m00 + m11 + m22
+    if trace > 0:
+        s = 2.0 * math.sqrt(trace + 1.0)
+        return ((m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s, 0.25 * s)
+    if m00 > m11 and m00 > m22:
+        s = 2.0 * math.sqrt(1.0 + m00 - m11 - m22)
+        return (0.25 * s, (m01 + m10) / s, (m02 + m20) / s, (m21 - m12) / s)
+    if m11 > m22:
+        s = 2.0 * math.sqrt(1.0 + m11 - m00 - m22)
+        return ((m01 + m10) / s, 0.25 * s, (m12 + m21) / s, (m02 - m20) / s)
+    s = 2.0 * math.sqrt(1.0 + m22 - m00 - m11)
+    return ((m02 + m20) / s, (m12 + m21) / s, 0.25 * s, (m10 - m01) / s)
+
 
 def to_transform(from_frame_id, to_frame_id, stamp, trans_mat):
-    t = tf.transformations.translation_from_matrix(trans_mat)
-    q = tf.transformations.quaternion_from_matrix(trans_mat)
+    t = (trans_mat[0][3], trans_mat[1][3], trans_mat[2][3])
+    q = quaternion_from_matrix(trans_mat)
     tf_msg = TransformStamped()
     tf_msg.header.stamp = stamp
     tf_msg.header.frame_id = from_frame_id
@@ -351,97 +701,76 @@ def to_transform(from_frame_id, to_frame_id, stamp, trans_mat):
     return tf_msg
 
 
-def convert_range_image_to_point_cloud(
-    frame, range_images, camera_projections, range_image_top_pose, ri_indexes=(0, 1)
+@tensorflow.function
+def extract_point_cloud(
+    range_images, extrinsic, beam_inclinations, pixel_pose=None, frame_pose=None
 ):
-    """Convert range images to point cloud. modified from
-    https://github.com/waymo-research/waymo-open-dataset/blob/master/waymo_open_dataset/utils/range_image_utils.py#L612
+    """Extract points and intensities of valid returns from a batch of range images
+    of the same lidar. Traced into a graph instead of dispatching every op eagerly.
 
     Args:
-      frame: open dataset frame
-       range_images: A dict of {laser_name, [range_image_first_return,
-         range_image_second_return]}.
-       camera_projections: A dict of {laser_name,
-         [camera_projection_from_first_return,
-         camera_projection_from_second_return]}.
-      range_image_top_pose: range image pixel pose for top lidar.
-      ri_indexes: 0 for the first return, 1 for the second return.
+      range_images: [B, H, W, C] range images, one per return.
+      extrinsic: [1, 4, 4] lidar extrinsic.
+      beam_inclinations: [1, H] beam inclinations.
+      pixel_pose: [1, H, W, 4, 4] per pixel pose, top lidar only.
+      frame_pose: [1, 4, 4] vehicle pose, top lidar only.
     Returns:
-      points: {[N, 3]} list of 3d lidar points of length 5 (number of lidars).
-      cp_points: {[N, 6]} list of camera projections of length 5
-        (number of lidars).
+      points: [N, 3] lidar points ordered by batch index.
+      intensity: [N] intensity of the lidar points.
+      num_points: [B] number of points in each range image.
     """
     tf = tensorflow
-    calibrations = sorted(frame.context.laser_calibrations, key=lambda c: c.name)
-    ret_dict = defaultdict(list)
-
-    frame_pose = tf.convert_to_tensor(value=np.reshape(np.array(frame.pose.transform), [4, 4]))
-    # [H, W, 6]
-    range_image_top_pose_tensor = tf.reshape(
-        tf.convert_to_tensor(value=range_image_top_pose.data), range_image_top_pose.shape.dims
-    )
-    # [H, W, 3, 3]
-    range_image_top_pose_tensor_rotation = transform_utils.get_rotation_matrix(
-        range_image_top_pose_tensor[..., 0],
-        range_image_top_pose_tensor[..., 1],
-        range_image_top_pose_tensor[..., 2],
-    )
-    range_image_top_pose_tensor_translation = range_image_top_pose_tensor[..., 3:]
-    range_image_top_pose_tensor = transform_utils.get_transform(
-        range_image_top_pose_tensor_rotation, range_image_top_pose_tensor_translation
+    batch_size = tf.shape(range_images)[0]
+    range_image_mask = range_images[..., 0] > 0
+
+    # No Label Zone
+    if FILTER_NO_LABEL_ZONE_POINTS:
+        nlz_mask = range_images[..., 3] != 1.0  # 1.0: in NLZ
+        range_image_mask = range_image_mask & nlz_mask
+
+    if pixel_pose is not None:
+        pixel_pose = tf.tile(pixel_pose, [batch_size, 1, 1, 1, 1])
+    if frame_pose is not None:
+        frame_pose = tf.tile(frame_pose, [batch_size, 1, 1])
+    range_image_cartesian = range_image_utils.extract_point_cloud_from_range_image(
+        range_images[..., 0],
+        tf.tile(extrinsic, [batch_size, 1, 1]),
+        tf.tile(beam_inclinations, [batch_size, 1]),
+        pixel_pose=pixel_pose,
+        frame_pose=frame_pose,
     )
 
-    for c in calibrations:
-        for ri_index in ri_indexes:
-            range_image = range_images[c.name][ri_index]
-            if len(c.beam_inclinations) == 0:
-                beam_inclinations = range_image_utils.compute_inclination(
-                    tf.constant([c.beam_inclination_min, c.beam_inclination_max]),
-                    height=range_image.shape.dims[0],
-                )
-            else:
-                beam_inclinations = tf.constant(c.beam_inclinations)
+    # [N, 3] indices of valid returns, shared by the points and intensity gathers
+    range_image_mask_indices = tf.where(range_image_mask)
+    points = tf.gather_nd(range_image_cartesian, range_image_mask_indices)
 
-            beam_inclinations = tf.reverse(beam_inclinations, axis=[-1])
-            extrinsic = np.reshape(np.array(c.extrinsic.transform), [4, 4])
+    # Note: channel 1 is intensity
+    # https://github.com/waymo-research/waymo-open-dataset/blob/master/waymo_open_dataset/dataset.proto#L176
+    intensity = tf.gather_nd(range_images[..., 1], range_image_mask_indices)
 
-            range_image_tensor = tf.reshape(
-                tf.convert_to_tensor(value=range_image.data), range_image.shape.dims
-            )
-            pixel_pose_local = None
-            frame_pose_local = None
-            if c.name == dataset_pb2.LaserName.TOP:
-                pixel_pose_local = range_image_top_pose_tensor
-                pixel_pose_local = tf.expand_dims(pixel_pose_local, axis=0)
-                frame_pose_local = tf.expand_dims(frame_pose, axis=0)
-            range_image_mask = range_image_tensor[..., 0] > 0
-
-            # No Label Zone
-            if FILTER_NO_LABEL_ZONE_POINTS:
-                nlz_mask = range_image_tensor[..., 3] != 1.0  # 1.0: in NLZ
-                range_image_mask = range_image_mask & nlz_mask
+    num_points = tf.reduce_sum(tf.cast(range_image_mask, tf.int32), axis=[1, 2])
 
-            range_image_cartesian = range_image_utils.extract_point_cloud_from_range_image(
-                tf.expand_dims(range_image_tensor[..., 0], axis=0),
-                tf.expand_dims(extrinsic, axis=0),
-                tf.expand_dims(tf.convert_to_tensor(value=beam_inclinations), axis=0),
-                pixel_pose=pixel_pose_local,
-                frame_pose=frame_pose_local,
-            )
-
-            range_image_cartesian = tf.squeeze(range_image_cartesian, axis=0)
-            points_tensor = tf.gather_nd(
-                range_image_cartesian, tf.compat.v1.where(range_image_mask)
-            )
+    return points, intensity, num_points
 
-            ret_dict["points_{}_{}".format(c.name, ri_index)].append(points_tensor.numpy())
 
-            # Note: channel 1 is intensity
-            # https://github.com/waymo-research/waymo-open-dataset/blob/master/waymo_open_dataset/dataset.proto#L176
-            intensity_tensor = tf.gather_nd(range_image_tensor[..., 1], tf.where(range_image_mask))
-            ret_dict["intensity_{}_{}".format(c.name, ri_index)].append(intensity_tensor.numpy())
-
-    return ret_dict
+def count_tfrecord_records(pathname):
+    """Count records of a tfrecord file by skipping over them without reading their data
+    Args:
+        pathname (str): path of the tfrecord file
+    Returns:
+        int: number of records
+    """
+    num_records = 0
+    with open(pathname, "rb") as f:
+        while True:
+            # a record is: uint64 length, uint32 length crc, data, uint32 data crc
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, = struct.unpack("<Q", header)
+            f.seek(length + 8, os.SEEK_CUR)
+            num_records += 1
+    return num_records
 
 
 def waymo2bag():
@@ -461,10 +790,17 @@ def waymo2bag():
         type=float,
         default=-1
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="number of tfrecords converted in parallel",
+    )
     args = parser.parse_args()
 
     converter = Waymo2Bag(args.load_dir, args.save_dir,
-        tracking_max_distance=args.tracking_max_distance)
+        tracking_max_distance=args.tracking_max_distance,
+        num_workers=args.num_workers)
     converter.convert()
 
 